@@ -1,17 +1,40 @@
 import httpx
+import orjson
+import argparse
 import asyncio
+import logging
+import math
 import os
-import re
+import queue
+import sys
+import time
+from contextlib import nullcontext, suppress
+from dataclasses import dataclass
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from dateutil.parser import parse as parse_date
-import piexif
-from gooey import Gooey, GooeyParser
 
 
-total_photos = 0
-photos_processed = 0
+logger = logging.getLogger("procare")
+# Cap on in-flight downloads so big accounts don't schedule thousands
+# of requests at once and trip Procare's rate limiting. The limit starts
+# lower and adapts to how the server responds, never exceeding the cap
+MAX_CONCURRENT_DOWNLOADS = 64
+INITIAL_CONCURRENT_DOWNLOADS = 16
+MAX_RETRIES = 5
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+EXIF_DT_FORMAT = "%Y:%m:%d %H:%M:%S"
+EXIF_WORKERS = 8
+
+@dataclass
+class Progress:
+    """Counts of photos to download and photos finished so far."""
+    total: int = 0
+    done: int = 0
+
 # Procare does a terrible job of normalizing the filenames
 # We clean them up here so that it's easier to check if we've 
 # already downloaded a photo
@@ -22,69 +45,258 @@ def check_filename_format(filename):
     
     return filename
 
-async def download_photos(client: httpx.AsyncClient, photo_urls: list, headers: dict, save_dir: str):
-    """Download and save photos from a list of URLs."""
-    Path(save_dir).mkdir(exist_ok=True)
-    tasks = []
-    for url in photo_urls:
-        tasks.append(download_single_photo(client, url, headers, save_dir))
-    await asyncio.gather(*tasks)
-
-async def download_single_photo(client: httpx.AsyncClient, photo: dict, headers: dict, save_dir: str):
-    """Download a single photo, save it, and update EXIF data, skipping if it exists."""
-    global total_photos, photos_processed
-    url = photo.get("main_url")
-    created_date = photo.get("created_date")
-    caption = photo.get("caption")
-    
+def photo_filename(url):
+    """Work out the local filename a photo URL will be saved under."""
+    # Extract filename from URL (e.g., .../main/photo12402.jpg?1209381038 -> photo12402.jpg)
+    # Plain string slicing is cheaper than a regex match for every photo
+    path = url.partition('?')[0]
+    start = path.find('/main/')
+    filename = path[start + len('/main/'):] if start != -1 else ''
+    return check_filename_format(filename or f"photo_{hash(url)}.jpg")
+
+class AdaptiveLimiter:
+    """Concurrency limit that adapts to the server (AIMD).
+
+    The limit grows by one after every run of successful responses and
+    halves when the server rate limits us or errors, so downloads go as
+    fast as Procare allows without constantly tripping its limiter.
+    """
+
+    def __init__(self, initial: int, maximum: int, increase_every: int = 10):
+        self.current = initial
+        self.max = maximum
+        self.in_flight = 0
+        self._increase_every = increase_every
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+        # Epoch time, per host, until which the server has told us to back off
+        self.rate_limit_resets = {}
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < self.current)
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    async def succeeded(self):
+        """Additive increase: raise the limit after enough successes."""
+        async with self._cond:
+            self._successes += 1
+            if self._successes >= self._increase_every and self.current < self.max:
+                self._successes = 0
+                self.current += 1
+                self._cond.notify()
+
+    async def throttled(self):
+        """Multiplicative decrease: halve the limit when the server pushes back."""
+        async with self._cond:
+            self._successes = 0
+            # Requests already in flight tend to fail together; count
+            # that as one signal rather than halving once for each
+            now = time.monotonic()
+            if now - self._last_decrease >= 1.0:
+                self._last_decrease = now
+                self.current = max(1, self.current // 2)
+
+def record_rate_limit(response: httpx.Response, limiter: AdaptiveLimiter) -> bool:
+    """Remember when to resume requests if the server says we're out of quota.
+
+    Returns True if the quota is used up.
+    """
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    reset = response.headers.get("X-RateLimit-Reset")
+    if remaining is None or reset is None:
+        return False
     try:
-        # Extract filename from URL (e.g., .../main/photo12402.jpg?1209381038 -> photo12402.jpg)
-        match = re.search(r'/main/([^?]+)', url)
-        filename = match.group(1) if match else f"photo_{hash(url)}.jpg"
-        filename = check_filename_format(filename)
-        file_path = os.path.join(save_dir, filename)
-
-        # Skip if file already exists
-        if os.path.exists(file_path):
-            print(f"Skipped photo: {file_path} (already exists)")
-            photos_processed += 1
-            print(f"Progress: {photos_processed}/{total_photos}")
-            return
+        if int(remaining) > 0:
+            return False
+        reset_at = float(reset)
+    except ValueError:
+        return False
+    # Some servers send seconds-until-reset instead of an epoch timestamp
+    if reset_at < 1_000_000_000:
+        reset_at += time.time()
+    limiter.rate_limit_resets[response.url.host] = reset_at
+    return True
 
-        # Download the photo
-        response = await client.get(url, headers=headers, timeout=30.0)
-        response.raise_for_status()
-        with open(file_path, "wb") as f:
-            f.write(response.content)
+def retry_delay(response: httpx.Response, attempt: int) -> float:
+    """Seconds to wait before retrying, preferring the server's Retry-After."""
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return 2 ** attempt
 
-        # Update EXIF data
-        try:
-            # Parse created_date to EXIF format (YYYY:MM:DD HH:MM:SS)
-            if created_date:
-                dt = parse_date(created_date)
-                exif_date = dt.strftime("%Y:%m:%d %H:%M:%S")
+async def wait_for_rate_limit(host: str, limiter: AdaptiveLimiter):
+    """Sleep until the last known rate limit window for a host has reset."""
+    delay = limiter.rate_limit_resets.get(host, 0) - time.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+def start_logging() -> QueueListener:
+    """Send log output to stdout from a background thread.
+
+    Coroutines only put records on a queue, so none of them block on console
+    writes. Messages stay bare so Gooey's progress regex still matches.
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    return listener
+
+def discard(part_path: str):
+    """Delete a partial download, if it's still there."""
+    with suppress(FileNotFoundError):
+        os.remove(part_path)
+
+async def download_to_file(client: httpx.AsyncClient, url: str, headers: dict, part_path: str, limiter: AdaptiveLimiter):
+    """Stream a URL to disk, retrying with exponential backoff on rate limits and server errors."""
+    host = httpx.URL(url).host
+    for attempt in range(MAX_RETRIES):
+        await wait_for_rate_limit(host, limiter)
+        async with client.stream("GET", url, headers=headers, timeout=30.0) as response:
+            out_of_quota = record_rate_limit(response, limiter)
+            if out_of_quota or response.status_code in RETRY_STATUS_CODES:
+                await limiter.throttled()
             else:
-                exif_date = datetime.now().strftime("%Y:%m:%d %H:%M:%S")  # Fallback
+                await limiter.succeeded()
+            delay = retry_delay(response, attempt)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == MAX_RETRIES - 1:
+                response.raise_for_status()
+                try:
+                    with open(part_path, "wb") as f:
+                        async for chunk in response.aiter_bytes(chunk_size=65536):
+                            f.write(chunk)
+                except BaseException:
+                    # Don't leave half a photo behind in the user's folder
+                    discard(part_path)
+                    raise
+                return
+        await asyncio.sleep(delay)
 
-            # Prepare EXIF data
-            exif_dict = {"0th": {}, "Exif": {}}
-            if exif_date:
-                exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal] = exif_date.encode("utf-8")
-            if caption:
-                exif_dict["0th"][piexif.ImageIFD.ImageDescription] = caption.encode("utf-8")[:2000]  # Max 2000 bytes
+# Photos from the same upload often share a timestamp, so the parsed
+# and formatted result is cached on the raw string
+@lru_cache(maxsize=4096)
+def exif_datetime(created_date: str) -> bytes:
+    """Convert a created_date string to an EXIF timestamp (YYYY:MM:DD HH:MM:SS)."""
+    # Procare sends ISO 8601, which fromisoformat handles far faster than
+    # dateutil; only fall back to dateutil for anything unusual
+    try:
+        dt = datetime.fromisoformat(created_date.replace('Z', '+00:00'))
+    except ValueError:
+        dt = parse_date(created_date)
+    return dt.strftime(EXIF_DT_FORMAT).encode("utf-8")
+
+def write_exif(file_path: str, created_date: str, caption: str):
+    """Write the photo's date and caption into its EXIF data."""
+    # Imported here so runs with nothing new to download never load it
+    import piexif
+
+    if created_date:
+        exif_date = exif_datetime(created_date)
+    else:
+        exif_date = datetime.now().strftime(EXIF_DT_FORMAT).encode("utf-8")  # Fallback
+
+    # Prepare EXIF data
+    exif_dict = {"0th": {}, "Exif": {}}
+    exif_dict["0th"][piexif.ImageIFD.DateTime] = exif_date
+    exif_dict["Exif"][piexif.ExifIFD.DateTimeOriginal] = exif_date
+    if caption:
+        exif_dict["0th"][piexif.ImageIFD.ImageDescription] = caption.encode("utf-8")[:2000]  # Max 2000 bytes
 
-            # Write EXIF data to the file
-            piexif.insert(piexif.dump(exif_dict), file_path)
+    # Write EXIF data to the file
+    piexif.insert(piexif.dump(exif_dict), file_path)
+
+async def download_photos(client: httpx.AsyncClient, photo_urls: list, headers: dict, save_dir: str, limiter: AdaptiveLimiter, progress: Progress):
+    """Download and save photos from a list of URLs."""
+    # Downloads hand finished files to a few EXIF workers rather than
+    # each writing its own EXIF data
+    exif_queue = asyncio.Queue()
+    workers = [asyncio.create_task(exif_worker(exif_queue, progress)) for _ in range(EXIF_WORKERS)]
+    try:
+        tasks = []
+        for url in photo_urls:
+            tasks.append(download_single_photo(client, url, headers, save_dir, limiter, exif_queue))
+        await asyncio.gather(*tasks)
+        await exif_queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        # A stopped run leaves photos waiting for EXIF; they were never
+        # finished, so don't leave their partial files lying around
+        while not exif_queue.empty():
+            _, part_path, _ = exif_queue.get_nowait()
+            discard(part_path)
+
+async def exif_worker(exif_queue: asyncio.Queue, progress: Progress):
+    """Update EXIF data for downloaded photos as they come off the queue.
+
+    Photos only get their real name once their EXIF has been written, so a
+    file under its final name is always a finished photo.
+    """
+    while True:
+        photo, part_path, file_path = await exif_queue.get()
+        exif_task = None
+        try:
+            # Update EXIF data off the event loop so downloads keep going
+            try:
+                exif_task = asyncio.ensure_future(
+                    asyncio.to_thread(write_exif, part_path, photo.get("created_date"), photo.get("caption"))
+                )
+                await asyncio.shield(exif_task)
+                saved_message = "Saved photo: %s"
+            except Exception as e:
+                # piexif can't handle every file Procare serves (PNGs, for
+                # one) and retrying won't change that, so keep the photo
+                logger.error("Failed to update EXIF for %s: %s", file_path, e)
+                saved_message = "Saved photo without EXIF: %s"
+
+            os.replace(part_path, file_path)
+            progress.done += 1
+            logger.info("Progress: %d/%d", progress.done, progress.total)
+            logger.info(saved_message, file_path)
         except Exception as e:
-            print(f"Failed to update EXIF for {file_path}: {str(e)}")
+            logger.error("Failed to save %s: %s", file_path, e)
+            discard(part_path)
+        except BaseException:
+            # Cancelling doesn't stop the thread, so let it finish writing
+            # before removing the file out from under it
+            if exif_task is not None:
+                await asyncio.wait([exif_task])
+            discard(part_path)
+            raise
+        finally:
+            exif_queue.task_done()
+
+async def download_single_photo(client: httpx.AsyncClient, photo: dict, headers: dict, save_dir: str, limiter: AdaptiveLimiter, exif_queue: asyncio.Queue):
+    """Download a single photo and queue it for its EXIF update."""
+    url = photo.get("main_url")
 
-        photos_processed += 1
-        print(f"Progress: {photos_processed}/{total_photos}")
-        print(f"Saved photo: {file_path}")
+    try:
+        file_path = os.path.join(save_dir, photo["filename"])
+        # Write to a temporary name so an interrupted download is never
+        # mistaken for a finished photo on the next run
+        part_path = file_path + ".part"
+
+        # Download the photo
+        async with limiter:
+            await download_to_file(client, url, headers, part_path, limiter)
+
+        await exif_queue.put((photo, part_path, file_path))
     except httpx.HTTPStatusError as e:
-        print(f"Failed to download {url}: HTTP {e.response.status_code}")
+        logger.error("Failed to download %s: HTTP %d", url, e.response.status_code)
     except Exception as e:
-        print(f"Failed to download {url}: {str(e)}")
+        logger.error("Failed to download %s: %s", url, e)
 
 async def fetch_photos_for_date_range(
     client: httpx.AsyncClient,
@@ -94,10 +306,8 @@ async def fetch_photos_for_date_range(
     datetime_to: datetime
 ) -> list:
     """Fetch all photo URLs for a given date range across paginated responses."""
-    all_photos = []
-    page = 1
-
-    while True:
+    async def fetch_page(page: int):
+        """Fetch one page, returning its photo objects and the raw response data."""
         try:
             params = {
                 "page": page,
@@ -106,35 +316,58 @@ async def fetch_photos_for_date_range(
             }
             response = await client.get(photos_url, headers=headers, params=params, timeout=30.0)
             response.raise_for_status()
-            data = response.json()
+            data = orjson.loads(response.content)
             photos = data.get("photos", [])
-            total = data.get("total", 0)
-            per_page = data.get("per_page", 50)
             # Collect photo objects with main_url, created_date, and caption
             photo_objects = [
                 {"main_url": photo["main_url"], "created_date": photo.get("created_at"), "caption": photo.get("caption")}
                 for photo in photos if "main_url" in photo
             ]
-            all_photos.extend(photo_objects)
-
-            print(f"Page {page} for {datetime_from.date()} to {datetime_to.date()}: {len(photo_objects)} photos")
 
-            if page * per_page >= total:
-                break
-            page += 1
+            logger.info("Page %d for %s to %s: %d photos", page, datetime_from.date(), datetime_to.date(), len(photo_objects))
+            return photo_objects, data
 
         except httpx.HTTPStatusError as e:
-            print(f"HTTP Error on page {page} for {datetime_from.date()} to {datetime_to.date()}: {e.response.status_code}")
-            break
+            logger.error("HTTP Error on page %d for %s to %s: %d", page, datetime_from.date(), datetime_to.date(), e.response.status_code)
         except Exception as e:
-            print(f"Error on page {page} for {datetime_from.date()} to {datetime_to.date()}: {str(e)}")
-            break
+            logger.error("Error on page %d for %s to %s: %s", page, datetime_from.date(), datetime_to.date(), e)
+        return [], None
+
+    # The first page tells us how many pages there are, so the rest
+    # can be requested all at once instead of one after another
+    all_photos, data = await fetch_page(1)
+    if data is None:
+        return all_photos
+
+    total = data.get("total", 0)
+    per_page = data.get("per_page", 50)
+    n_pages = math.ceil(total / per_page) if per_page else 1
+    pages = await asyncio.gather(*(fetch_page(page) for page in range(2, n_pages + 1)))
+    for photo_objects, _ in pages:
+        all_photos.extend(photo_objects)
 
     return all_photos
 
-async def run_download(email: str, password: str, start_datetime: datetime, save_dir: str):
-    global total_photos
-    """Core async function to handle login, photo fetching, and downloading."""
+def create_client() -> httpx.AsyncClient:
+    """Build the pooled HTTP/2 client shared by login, listing, and downloads."""
+    # Size the pool to the download cap so every download the limiter lets
+    # through gets a connection, rather than timing out waiting for one
+    return httpx.AsyncClient(
+        http2=True,
+        verify=True,
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENT_DOWNLOADS,
+            max_keepalive_connections=MAX_CONCURRENT_DOWNLOADS,
+            keepalive_expiry=30
+        )
+    )
+
+async def run_download(email: str, password: str, start_datetime: datetime, save_dir: str, client: httpx.AsyncClient | None = None):
+    """Core async function to handle login, photo fetching, and downloading.
+
+    Pass an already open client to reuse its connection pool across runs;
+    otherwise one is created and closed here.
+    """
     auth_url = 'https://online-auth.procareconnect.com/sessions/'
     photos_url = 'https://api-school.procareconnect.com/api/web/parent/photos/'
     payload = {
@@ -146,17 +379,18 @@ async def run_download(email: str, password: str, start_datetime: datetime, save
     datetime_to = datetime.now() + timedelta(days=1)
     datetime_to = datetime_to.replace(hour=0, minute=0, second=0, microsecond=0)
 
-    async with httpx.AsyncClient(http2=True, verify=True, limits=httpx.Limits(max_connections=20)) as client:
+    cm = nullcontext(client) if client is not None else create_client()
+    async with cm as client:
         try:
             # Step 1: Log in
             login_response = await client.post(auth_url, json=payload, timeout=30.0)
             login_response.raise_for_status()
-            login_data = login_response.json()
+            login_data = orjson.loads(login_response.content)
             token = login_data.get("auth_token")
             if not token:
-                print("Error: No token found in login response")
+                logger.error("Error: No token found in login response")
                 return
-            print("Login successful, Token:", token)
+            logger.info("Login successful, Token: %s", token)
 
             headers = {"Authorization": f"Bearer {token}"}
             all_photo_urls = []
@@ -168,7 +402,7 @@ async def run_download(email: str, password: str, start_datetime: datetime, save
                     start_datetime,
                     current_to - relativedelta(months=1)
                 )
-                print(f"Getting photo list from {current_from.date()} to {current_to.date()}")
+                logger.info("Getting photo list from %s to %s", current_from.date(), current_to.date())
 
                 photo_urls = await fetch_photos_for_date_range(
                     client, photos_url, headers, current_from, current_to
@@ -177,21 +411,51 @@ async def run_download(email: str, password: str, start_datetime: datetime, save
                 current_to = current_from
 
             if not all_photo_urls:
-                print("No photo URLs found")
+                logger.info("No photo URLs found")
+                return
+
+            # Adjacent months can return the same photo, and differing
+            # cache-busters can map different URLs to one file, so keep
+            # only the first photo for each filename
+            unique_photos = {}
+            for photo in all_photo_urls:
+                photo["filename"] = photo_filename(photo["main_url"])
+                unique_photos.setdefault(photo["filename"], photo)
+            duplicates = len(all_photo_urls) - len(unique_photos)
+            if duplicates:
+                logger.info("Ignored %d duplicate photos", duplicates)
+
+            # Skip photos we already have, using one directory listing
+            # rather than checking for each file individually. Photos only
+            # get their real name once downloaded and tagged with EXIF, so
+            # any file found here is a finished photo
+            Path(save_dir).mkdir(exist_ok=True)
+            existing = {entry.name for entry in os.scandir(save_dir)}
+            # A killed run never gets to clean up, so clear out its leftovers
+            for name in existing:
+                if name.endswith(".part"):
+                    discard(os.path.join(save_dir, name))
+            to_download = [p for name, p in unique_photos.items() if name not in existing]
+            skipped = len(unique_photos) - len(to_download)
+            if skipped:
+                logger.info("Skipped %d photos (already exist)", skipped)
+            if not to_download:
+                logger.info("No new photos to download")
                 return
 
-            print(f"Total photo URLs to download: {len(all_photo_urls)}")
-            total_photos = len(all_photo_urls)
+            logger.info("Total photo URLs to download: %d", len(to_download))
+            progress = Progress(total=len(to_download))
 
             # Step 3: Download photos
-            await download_photos(client, all_photo_urls, headers, save_dir)
+            limiter = AdaptiveLimiter(INITIAL_CONCURRENT_DOWNLOADS, MAX_CONCURRENT_DOWNLOADS)
+            await download_photos(client, to_download, headers, save_dir, limiter, progress)
 
         except httpx.HTTPStatusError as e:
-            print(f"HTTP Error: {e.response.status_code} - {e.response.text}")
+            logger.error("HTTP Error: %d - %s", e.response.status_code, e.response.text)
         except Exception as e:
-            print(f"Error: {str(e)}")
+            logger.error("Error: %s", e)
 
-@Gooey(
+GOOEY_OPTIONS = dict(
     program_name="Photo Downloader",
     default_size=(800, 600),
     required_cols=1,
@@ -202,21 +466,35 @@ async def run_download(email: str, password: str, start_datetime: datetime, save
     show_success_modal=True,
     show_failure_modal=True
 )
-def main():
-    parser = GooeyParser(description="Download photos from example.com API")
-    parser.add_argument(
+
+def build_parser(gui: bool):
+    """Build the argument parser, with Gooey widgets when showing the GUI."""
+    if gui:
+        from gooey import GooeyParser
+        parser = GooeyParser(description="Download photos from example.com API")
+    else:
+        parser = argparse.ArgumentParser(description="Download photos from example.com API")
+
+    def add_argument(name, widget, gooey_options=None, **kwargs):
+        if gui:
+            kwargs["widget"] = widget
+            if gooey_options:
+                kwargs["gooey_options"] = gooey_options
+        parser.add_argument(name, **kwargs)
+
+    add_argument(
         "--email",
         help="Email for login",
         widget="TextField",
         required=True
     )
-    parser.add_argument(
+    add_argument(
         "--password",
         help="Password for login",
         widget="PasswordField",
         required=True
     )
-    parser.add_argument(
+    add_argument(
         "--start_date",
         help="Start date for photos (YYYY-MM-DD)",
         widget="DateChooser",
@@ -225,7 +503,7 @@ def main():
             "default": datetime(2024, 1, 1).strftime("%Y-%m-%d")
         }
     )
-    parser.add_argument(
+    add_argument(
         "--save_dir",
         help="Folder to save photos",
         widget="DirChooser",
@@ -234,7 +512,21 @@ def main():
             "default": os.path.join(os.getcwd(), "downloaded_photos")
         }
     )
+    return parser
 
+def main():
+    # Gooey runs this script again with --ignore-gooey to do the actual
+    # work, and the flag can be passed by hand to use it from a terminal.
+    # Neither needs a window, so don't pay for importing gooey and wx
+    if "--ignore-gooey" in sys.argv:
+        sys.argv.remove("--ignore-gooey")
+        run(build_parser(gui=False))
+    else:
+        from gooey import Gooey
+        Gooey(**GOOEY_OPTIONS)(lambda: run(build_parser(gui=True)))()
+
+def run(parser):
+    """Parse the command line, check the save folder, and download."""
     args = parser.parse_args()
 
     try:
@@ -255,7 +547,11 @@ def main():
         return
 
     # Run async function
-    asyncio.run(run_download(args.email, args.password, start_datetime, args.save_dir))
+    listener = start_logging()
+    try:
+        asyncio.run(run_download(args.email, args.password, start_datetime, args.save_dir))
+    finally:
+        listener.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file